@@ -1,4 +1,6 @@
 from .testing import DeviceUnderTest, Test, testStep, TestStep, testResult, TestResult
 from .csvReport import CsvReport
 from .gitRepo import commitSha
+from .replay import Recorder, Replay, ReplayedError
+from .ordering import StepOrderOptimizer
 from uuid import getnode as get_mac
\ No newline at end of file
@@ -0,0 +1,221 @@
+import os
+import shutil
+import json
+import unittest
+from .testing import TestState
+from .replay import _stepRecordFailed, _recordComplete, Recorder, Replay
+
+
+# Reorders the steps of a Test so that cheap, frequently failing steps run first,
+# minimizing the expected time until a failing DUT is rejected.
+# Statistics are loaded from recordings made by a Recorder and updated after every run of the Test.
+# Only steps declared with dependsOn can move; a step's dependencies always run before it.
+class StepOrderOptimizer(object):
+    def __init__(self, recordings=()):
+        self._runs = {}
+        self._failures = {}
+        self._durations = {}
+        self._pendingRecords = {} # recorded steps, evaluated once the steps' criteria are known
+        if isinstance(recordings, str):
+            recordings = [recordings]
+        for filePath in recordings:
+            with open(filePath) as recordingFile:
+                for line in recordingFile:
+                    if not line.strip():
+                        continue
+                    record = json.loads(line)
+                    if not _recordComplete(record):
+                        continue
+                    for identifier, stepRecord in record["steps"].items():
+                        self._pendingRecords.setdefault(identifier, []).append(stepRecord)
+
+    def order(self, steps):
+        self._evaluateRecords(steps)
+        knownDurations = [self._durations[key] / self._runs[key] for key in self._runs.keys() if self._runs[key] > 0]
+        defaultDuration = sum(knownDurations) / len(knownDurations) if len(knownDurations) > 0 else 0
+
+        def cost(step):
+            key = str(step.identifier)
+            runs = self._runs.get(key, 0)
+            duration = self._durations[key] / runs if runs > 0 else defaultDuration
+            failureRate = (self._failures.get(key, 0) + 1.0) / (runs + 2.0)
+            return duration / failureRate
+
+        remaining = list(steps)
+        ordered = []
+        while len(remaining) > 0:
+            available = [step for step in remaining if all(dependency in ordered for dependency in self._dependencies(step, steps))]
+            nextStep = min(available, key=lambda step: (cost(step), steps.index(step)))
+            remaining.remove(nextStep)
+            ordered.append(nextStep)
+        return ordered
+
+    def _dependencies(self, step, steps):
+        if step.dependsOn is None:
+            return steps[:steps.index(step)]
+        return step.dependsOn
+
+    def _evaluateRecords(self, steps):
+        for step in steps:
+            key = str(step.identifier)
+            for stepRecord in self._pendingRecords.pop(key, []):
+                self._count(key, _stepRecordFailed(step, stepRecord), stepRecord["duration"])
+
+    def _observe(self, test):
+        for target in test.targets:
+            for step in test._runOrder:
+                outcome = step._outcome(target)
+                if outcome == TestState.PENDING or outcome == TestState.ABORTED:
+                    continue
+                self._count(str(step.identifier), outcome in TestState.abortingStatuses, target._durations.get(step, 0))
+
+    def _count(self, key, failed, duration):
+        self._runs[key] = self._runs.get(key, 0) + 1
+        self._failures[key] = self._failures.get(key, 0) + (1 if failed else 0)
+        self._durations[key] = self._durations.get(key, 0) + duration
+
+
+class TestStepOrderOptimizer(unittest.TestCase):
+    directory = "tempDir"
+    def setUp(self):
+        if os.path.exists(TestStepOrderOptimizer.directory):
+            shutil.rmtree(TestStepOrderOptimizer.directory)
+        os.mkdir(TestStepOrderOptimizer.directory)
+        self.filePath = TestStepOrderOptimizer.directory + "/recording.jsonl"
+
+    def tearDown(self):
+        shutil.rmtree(TestStepOrderOptimizer.directory)
+
+    def _writeRecording(self, current):
+        def stepRecord(description, duration, resultValues):
+            return {"description": description, "duration": duration, "resultValues": resultValues, "error": None, "prompts": [], "name": "DUT"}
+        with open(self.filePath, 'w') as f:
+            for value in current:
+                f.write(json.dumps({"name": "DUT", "steps": {
+                    "1": stepRecord("Scan Barcode", 1.0, {}),
+                    "2": stepRecord("Load Firmware", 20.0, {}),
+                    "3": stepRecord("Measure Current", 0.5, {"Current": value}),
+                    "4": stepRecord("Configure Settings", 0.1, {}),
+                }}) + '\n')
+
+    def test_order(self):
+        from . import testing
+        # Half of the recorded boards draw too much current
+        self._writeRecording([700, 900, 700, 900])
+        test = testing.Test(targets=[testing.DeviceUnderTest()], optimizer=StepOrderOptimizer(self.filePath))
+        current = testing.TestResult("Current", criteria=lambda x: x is not None and x < 800, units="microAmps")
+        executed = []
+
+        @testing.testStep(test, "Scan Barcode")
+        def scan(self, target):
+            executed.append(self)
+
+        @testing.testStep(test, "Load Firmware", dependsOn=scan)
+        def firmware(self, target):
+            executed.append(self)
+
+        @testing.testStep(test, "Measure Current", results=(current), dependsOn=scan)
+        def measure(self, target):
+            executed.append(self)
+            target.resultValues[current] = 900
+
+        @testing.testStep(test, "Configure Settings", dependsOn=firmware)
+        def configure(self, target):
+            executed.append(self)
+
+        header = test.exportResultsHeader()
+        self.assertEqual(test.optimizer.order(test.steps), [scan, measure, firmware, configure])
+
+        test.run()
+        self.assertEqual(executed, [scan, measure])
+        self.assertEqual(test.targets[0]._failingStep(test), measure)
+        self.assertEqual(test.targets[0]._state(test), testing.TestState.FAILURE)
+        self.assertEqual(test.exportResultsHeader(), header)
+        self.assertEqual(test.steps, [scan, firmware, measure, configure])
+
+    def test_undeclaredDependencies(self):
+        from . import testing
+        self._writeRecording([900, 900])
+        test = testing.Test(targets=[testing.DeviceUnderTest()])
+        current = testing.TestResult("Current")
+        steps = []
+        for description, results in [("Scan Barcode", ()), ("Load Firmware", ()), ("Measure Current", (current,)), ("Configure Settings", ())]:
+            steps.append(testing.TestStep(test, None, description, results, lambda self, target: None))
+            test.addStep(steps[-1])
+        self.assertEqual(StepOrderOptimizer(self.filePath).order(test.steps), steps)
+
+    def test_dependencyList(self):
+        from . import testing
+        test = testing.Test(targets=[testing.DeviceUnderTest()])
+        scan = testing.TestStep(test, None, "Scan Barcode", (), lambda self, target: None)
+        test.addStep(scan)
+        firmware = testing.TestStep(test, None, "Load Firmware", (), lambda self, target: None, dependsOn=[scan])
+        test.addStep(firmware)
+        configure = testing.TestStep(test, None, "Configure Settings", (), lambda self, target: None, dependsOn=[scan, firmware])
+        test.addStep(configure)
+        self.assertEqual(configure.dependsOn, (scan, firmware))
+        self.assertEqual(StepOrderOptimizer().order(test.steps), [scan, firmware, configure])
+
+    def _buildReplayTest(self, replay=None, recorder=None, optimizer=None):
+        from . import testing
+        test = testing.Test(targets=[testing.DeviceUnderTest("a"), testing.DeviceUnderTest("b")], recorder=recorder, replay=replay, optimizer=optimizer)
+        current = testing.TestResult("Current", criteria=lambda x: x is not None and x < 800)
+        locale = testing.TestResult("Locale")
+        scan = testing.TestStep(test, None, "Scan Barcode", (), lambda self, target: None)
+        test.addStep(scan)
+        def measureFunction(self, target):
+            target.resultValues[current] = 900 if target.name == "a" else 700
+        measure = testing.TestStep(test, None, "Measure Current", (current,), measureFunction, dependsOn=scan)
+        test.addStep(measure)
+        def configureFunction(self, target):
+            target.resultValues[locale] = "English (UK)"
+        configure = testing.TestStep(test, None, "Configure Settings", (locale,), configureFunction, dependsOn=scan)
+        test.addStep(configure)
+        return test, scan, measure, configure, locale
+
+    def test_replayReordered(self):
+        from . import testing
+        recordingPath = TestStepOrderOptimizer.directory + "/panel.jsonl"
+        test, _, _, _, _ = self._buildReplayTest(recorder=Recorder(recordingPath))
+        test.run()
+
+        # Statistics under which configuring is cheaper to run first
+        def stepRecord(duration):
+            return {"duration": duration, "resultValues": {}, "error": None, "prompts": [], "name": "DUT"}
+        with open(self.filePath, 'w') as f:
+            f.write(json.dumps({"name": "DUT", "steps": {"1": stepRecord(1.0), "2": stepRecord(10.0), "3": stepRecord(0.1)}}) + '\n')
+
+        def replayTest(replay, renumber=False):
+            test, scan, measure, configure, locale = self._buildReplayTest(replay=replay, optimizer=StepOrderOptimizer(self.filePath))
+            for step in test.steps:
+                step._function = lambda step, target: self.fail("Step function called during replay")
+            if renumber:
+                configure.identifier = 4
+            test.run()
+            self.assertEqual(test._runOrder, [scan, configure, measure])
+            return test, measure, locale
+
+        # Without filling, the step the failing DUT never recorded can't be replayed
+        test, _, _ = replayTest(Replay(recordingPath, speed=None))
+        failingTarget, passingTarget = test.targets
+        self.assertEqual(failingTarget._state(test), testing.TestState.ERROR)
+        self.assertEqual(str(failingTarget._errors[test.steps[2]]), "No recording of step #3 for a")
+        self.assertEqual(passingTarget._state(test), testing.TestState.SUCCESS)
+
+        replay = Replay(recordingPath, speed=None, fillReorderedSteps=True)
+        test, measure, locale = replayTest(replay)
+        failingTarget, passingTarget = test.targets
+        self.assertEqual(failingTarget._state(test), testing.TestState.FAILURE)
+        self.assertEqual(failingTarget._failingStep(test), measure)
+        self.assertEqual(failingTarget.resultValues[locale], "English (UK)")
+        self.assertEqual(passingTarget._state(test), testing.TestState.SUCCESS)
+        self.assertEqual(replay.filledSteps, [("a", 3)])
+
+        # Recordings that don't match the test aren't filled in
+        replay = Replay(recordingPath, speed=None, fillReorderedSteps=True)
+        test, _, _ = replayTest(replay, renumber=True)
+        self.assertEqual([target._state(test) for target in test.targets], [testing.TestState.ERROR, testing.TestState.ERROR])
+        self.assertEqual(replay.filledSteps, [])
+
+if __name__ == '__main__':
+    unittest.main()
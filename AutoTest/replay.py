@@ -0,0 +1,285 @@
+import os
+import shutil
+import time
+import json
+import unittest
+from .testing import TestResult
+
+
+# Raised in place of the exception a step originally produced when it is replayed
+class ReplayedError(Exception):
+    def __init__(self, message, typeName=None, trace=None):
+        super(ReplayedError, self).__init__(message)
+        self.typeName = typeName
+        self.trace = trace
+
+
+# Whether a recorded step errored or any of its recorded results fail the step's criteria
+def _stepRecordFailed(step, stepRecord):
+    if stepRecord["error"] is not None:
+        return True
+    for result in step.results:
+        try:
+            if result.criteria(stepRecord["resultValues"].get(result.description)) == TestResult.Outcome.FAIL:
+                return True
+        except Exception:
+            return True
+    return False
+
+
+# Whether a recording holds a run that wasn't interrupted. Recordings without the field predate it and are complete.
+def _recordComplete(record):
+    return record.get("complete", True)
+
+
+# Records what every step did to every target so the Test can be replayed later without hardware.
+# Each target's recording is appended to the file as one JSON line once the Test finishes running.
+# Runs that were interrupted are written with "complete" set to false, and are skipped by Replay and StepOrderOptimizer.
+class Recorder(object):
+    def __init__(self, filePath):
+        self.filePath = filePath
+        self._records = {}
+        self._prompts = []
+
+    def _begin(self, targets):
+        self._records = {}
+        for target in targets:
+            self._records[target] = {"name": target.name, "steps": {}}
+
+    def _recordPrompt(self, message, answer):
+        self._prompts.append([message, answer])
+
+    def _beginStep(self):
+        self._prompts = []
+
+    # Called by Test.run once the step has run, with its errors and duration stored on the targets
+    def _recordStep(self, step, targets):
+        for target in targets:
+            resultValues = {}
+            for result in step.results:
+                if result in target.resultValues.keys():
+                    resultValues[result.description] = target.resultValues[result]
+            error = None
+            if step in target._errors.keys():
+                e = target._errors[step]
+                error = {"type": e.__class__.__name__, "message": str(e), "trace": target._trace.get(step)}
+            self._records[target]["steps"][str(step.identifier)] = {
+                "description": step.description,
+                "duration": target._durations[step],
+                "resultValues": resultValues,
+                "error": error,
+                "prompts": self._prompts,
+                "name": target.name,
+            }
+
+    def _end(self, targets, complete=True):
+        with open(self.filePath, 'a') as recordingFile:
+            for target in targets:
+                if target in self._records.keys():
+                    # The steps may have renamed the target, e.g. from a scanned barcode
+                    self._records[target]["name"] = target.name
+                    self._records[target]["complete"] = complete
+                    # Values that can't be represented in JSON are stored as their string
+                    recordingFile.write(json.dumps(self._records[target], default=str) + '\n')
+
+
+# Drives a Test from the recordings of a Recorder instead of calling the step functions.
+# Every run of the Test consumes the next recorded DUT for each of its targets.
+# speed scales the recorded step durations (2.0 replays twice as fast); None skips the delays entirely.
+# When the steps run in a different order than they were recorded in (see StepOrderOptimizer), a DUT can reach
+# a step it never recorded because its recording ended at a failure. With fillReorderedSteps, that step is played
+# from another DUT that passed it, so the DUT still goes on to its recorded failure. The filled in steps are
+# listed in filledSteps as (target name, step identifier). Any other missing step raises a ReplayedError.
+class Replay(object):
+    def __init__(self, filePath, speed=1.0, loop=False, fillReorderedSteps=False):
+        self.speed = speed
+        self.loop = loop
+        self.fillReorderedSteps = fillReorderedSteps
+        self.filledSteps = []
+        self.records = []
+        with open(filePath) as recordingFile:
+            for line in recordingFile:
+                if line.strip():
+                    record = json.loads(line)
+                    if _recordComplete(record):
+                        self.records.append(record)
+        self._cursor = 0
+        self._activeRecords = {}
+        self._playedSteps = {}
+        self._passingRecords = {}
+
+    def remaining(self):
+        return len(self.records) - self._cursor
+
+    def _begin(self, targets):
+        self._activeRecords = {}
+        self._playedSteps = {}
+        for target in targets:
+            if self._cursor >= len(self.records):
+                if not self.loop or len(self.records) == 0:
+                    raise IndexError("No recorded DUTs left to replay")
+                self._cursor = 0
+            record = self.records[self._cursor]
+            self._cursor += 1
+            self._activeRecords[target] = record
+            self._playedSteps[target] = set()
+            target.name = record["name"]
+
+    def _playStep(self, step, targets):
+        key = str(step.identifier)
+        stepRecords = []
+        for target in targets:
+            recordedSteps = self._activeRecords[target]["steps"]
+            stepRecord = recordedSteps.get(key)
+            if stepRecord is None and self.fillReorderedSteps and self._failureAhead(step, target):
+                passingRecord = self._passingRecord(step)
+                if passingRecord is not None:
+                    stepRecord = dict(passingRecord, name=target.name)
+                    self.filledSteps.append((target.name, step.identifier))
+            self._playedSteps[target].add(key)
+            stepRecords.append(stepRecord)
+
+        durations = [stepRecord["duration"] for stepRecord in stepRecords if stepRecord is not None]
+        if self.speed and len(durations) > 0:
+            time.sleep(max(durations) / self.speed)
+
+        error = None
+        for target, stepRecord in zip(targets, stepRecords):
+            if stepRecord is None:
+                error = error or ReplayedError("No recording of step #%s for %s" % (step.identifier, target.name))
+                continue
+            for result in step.results:
+                if result.description in stepRecord["resultValues"].keys():
+                    target.resultValues[result] = stepRecord["resultValues"][result.description]
+            target.name = stepRecord["name"]
+            if stepRecord["error"] is not None and error is None:
+                recordedError = stepRecord["error"]
+                error = ReplayedError(recordedError["message"], recordedError["type"], recordedError["trace"])
+
+        if error is not None:
+            raise error
+
+    # Whether the target's recording ended at a failing step of this test that hasn't been played yet,
+    # in which case the DUT would have reached any step missing from its recording
+    def _failureAhead(self, step, target):
+        recordedSteps = self._activeRecords[target]["steps"]
+        steps = dict((str(testStep.identifier), testStep) for testStep in step._test.steps)
+        if len(recordedSteps) == 0 or any(key not in steps.keys() for key in recordedSteps.keys()):
+            return False # the recording doesn't match this test
+        failingKey = list(recordedSteps.keys())[-1]
+        if failingKey in self._playedSteps[target]:
+            return False
+        return _stepRecordFailed(steps[failingKey], recordedSteps[failingKey])
+
+    def _passingRecord(self, step):
+        key = str(step.identifier)
+        if key not in self._passingRecords.keys():
+            self._passingRecords[key] = None
+            for record in self.records:
+                if key in record["steps"].keys() and not _stepRecordFailed(step, record["steps"][key]):
+                    self._passingRecords[key] = record["steps"][key]
+                    break
+        return self._passingRecords[key]
+
+
+class TestReplay(unittest.TestCase):
+    directory = "tempDir"
+    def setUp(self):
+        if os.path.exists(TestReplay.directory):
+            shutil.rmtree(TestReplay.directory)
+        os.mkdir(TestReplay.directory)
+        self.filePath = TestReplay.directory + "/recording.jsonl"
+        from . import testing
+        self.promptFunc = testing.promptFunc
+
+    def tearDown(self):
+        from . import testing
+        testing.promptFunc = self.promptFunc
+        shutil.rmtree(TestReplay.directory)
+
+    def _buildTest(self, voltage, recorder=None, replay=None):
+        from . import testing
+        test = testing.Test(targets=[testing.DeviceUnderTest()], name="Replay Test", recorder=recorder, replay=replay)
+        serialNumber = testing.TestResult("Serial Number")
+        batteryVoltage = testing.TestResult("Battery Voltage", criteria=lambda x: x is not None and x > 3.0, units="volts")
+
+        @testing.testStep(test, "Scan Barcode", results=(serialNumber))
+        def step(self, target):
+            target.name = self.prompt("Scan the DUT's barcode")
+            target.resultValues[serialNumber] = target.name
+
+        @testing.testStep(test, "Measure Battery", results=(batteryVoltage))
+        def step(self, target):
+            if voltage is None:
+                raise IOError("Instrument not found")
+            target.resultValues[batteryVoltage] = voltage
+
+        return test, serialNumber, batteryVoltage
+
+    def test_recordAndReplay(self):
+        from . import testing
+        testing.promptFunc = lambda message: "SN12345"
+        test, _, _ = self._buildTest(3.7, recorder=Recorder(self.filePath))
+        test.run()
+        test, _, _ = self._buildTest(None, recorder=Recorder(self.filePath))
+        test.run()
+
+        with open(self.filePath) as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records[0]["name"], "SN12345")
+        self.assertTrue(records[0]["complete"])
+        self.assertEqual(records[0]["steps"]["1"]["prompts"], [["Scan the DUT's barcode", "SN12345"]])
+        self.assertEqual(records[1]["steps"]["2"]["error"]["type"], "OSError")
+
+        # The step functions of the replayed test would fail if they were called
+        testing.promptFunc = lambda message: self.fail("Prompted during replay")
+        replay = Replay(self.filePath, speed=None)
+        test, serialNumber, batteryVoltage = self._buildTest(None, replay=replay)
+        test.run()
+        target = test.targets[0]
+        self.assertEqual(target.name, "SN12345")
+        self.assertEqual(target.resultValues[serialNumber], "SN12345")
+        self.assertEqual(target.resultValues[batteryVoltage], 3.7)
+        self.assertEqual(target._state(test), testing.TestState.SUCCESS)
+
+        test.run()
+        self.assertEqual(target._state(test), testing.TestState.ERROR)
+        self.assertEqual(str(target._errors[test.steps[1]]), "Instrument not found")
+        self.assertEqual(target._trace[test.steps[1]], records[1]["steps"]["2"]["error"]["trace"])
+        self.assertEqual(replay.remaining(), 0)
+        self.assertRaises(IndexError, test.run)
+
+    def test_interruptedRun(self):
+        from . import testing
+        testing.promptFunc = lambda message: "SN12345"
+        test, _, _ = self._buildTest(3.7, recorder=Recorder(self.filePath))
+        def interrupt(self, target):
+            raise KeyboardInterrupt()
+        test.steps[1]._function = interrupt
+        self.assertRaises(KeyboardInterrupt, test.run)
+
+        with open(self.filePath) as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]["steps"]["1"]["resultValues"], {"Serial Number": "SN12345"})
+        self.assertNotIn("2", records[0]["steps"].keys())
+        self.assertFalse(records[0]["complete"])
+
+        # Interrupted runs are neither replayed nor counted in the step statistics
+        test, _, _ = self._buildTest(3.7, recorder=Recorder(self.filePath))
+        test.run()
+        replay = Replay(self.filePath, speed=None)
+        self.assertEqual(replay.remaining(), 1)
+        test, _, batteryVoltage = self._buildTest(None, replay=replay)
+        test.run()
+        self.assertEqual(test.targets[0]._state(test), testing.TestState.SUCCESS)
+        self.assertEqual(test.targets[0].resultValues[batteryVoltage], 3.7)
+
+        from .ordering import StepOrderOptimizer
+        optimizer = StepOrderOptimizer(self.filePath)
+        optimizer.order(test.steps)
+        self.assertEqual(optimizer._runs, {"1": 1, "2": 1})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -10,6 +10,8 @@ import os
 import sys
 from .csvReport import CsvReport
 import traceback
+import unittest
+from collections import OrderedDict
 
 def parametrizedDecorator(dec):
     def layer(*args, **kwargs):
@@ -69,17 +71,23 @@ class DeviceUnderTest(object):
         self.resultValues = {}
         self._errors = {}
         self._trace = {}
+        self._durations = {}
         self._activeStep = 0
+        self._runState = TestState.PENDING # kept up to date by Test.run
+        self._warned = False
 
     def reset(self):
         self.resultValues = {}
         self._errors = {}
         self._trace = {}
+        self._durations = {}
         self._activeStep = 0
+        self._runState = TestState.PENDING # kept up to date by Test.run
+        self._warned = False
 
     def _state(self, test):
         outcome = TestState.SUCCESS
-        for step_idx, step in enumerate(test.steps):
+        for step_idx, step in enumerate(test._runOrder):
             stepOutcome = step._outcome(self)
             if stepOutcome in TestState.abortingStatuses:
                 return stepOutcome
@@ -91,7 +99,7 @@ class DeviceUnderTest(object):
 
     # Call this only when the test is incomplete
     def _failingStep(self, test):
-        for step_idx, step in enumerate(test.steps):
+        for step_idx, step in enumerate(test._runOrder):
             if step_idx >= self._activeStep:
                 return None
             stepOutcome = step._outcome(self)
@@ -107,8 +115,10 @@ class Test:
         COMPLETE = "Complete"
         ERROR = "ERROR"
 
-    def __init__(self, targets=[DeviceUnderTest()], name=None, version=None, identifier=None, successStateOverride=None, reports=None):
-        self.steps = []
+    def __init__(self, targets=[DeviceUnderTest()], name=None, version=None, identifier=None, successStateOverride=None, reports=None, recorder=None, replay=None, optimizer=None, maxDisplayedTargets=16):
+        self.steps = [] # canonical order, used for displaying and exporting results
+        self._runOrder = [] # order the steps are executed in
+        self._runIndex = {}
         self.name = name
         self.version = version
         self.identifier = identifier
@@ -129,71 +139,153 @@ class Test:
         for report in self.reports:
             report.headerRow = self.exportResultsHeader()
 
-        self._activeTargets = []
+        self.recorder = recorder # records step outcomes for later replay
+        self.replay = replay # when set, steps are replayed from a recording instead of being run
+        self.optimizer = optimizer # when set, reorders the steps before each run
+        self.maxDisplayedTargets = maxDisplayedTargets # above this many targets, a summary is displayed instead of every result
+
+        self._activeTargets = OrderedDict()
         self.reset()
 
     def addStep(self, step):
         if step.identifier == None:
             step.identifier = len(self.steps)+1
+        if step.dependsOn is not None:
+            for dependency in step.dependsOn:
+                if dependency not in self.steps:
+                    raise ValueError("Step dependencies must be added to the test before the steps depending on them")
         step._test = self
         self.steps.append(step)
+        self._setRunOrder(self._runOrder + [step])
+        if len(self._runOrder) == 1:
+            self._resetCounts() # the targets were counted as passing while the test had no steps
         for report in self.reports:
             report.headerRow = self.exportResultsHeader()
 
     def reset(self):
         for target in self.targets:
             target.reset()
-        self._activeTargets = self.targets[:]
+        self._activeTargets = OrderedDict((target, None) for target in self.targets)
+        self._resetCounts()
+
+    def _resetCounts(self):
+        # Number of targets in each state, and the outcomes of each step, updated as the steps complete
+        # A test without steps has nothing left to run, so its targets have passed
+        state = TestState.PENDING if len(self._runOrder) > 0 else TestState.SUCCESS
+        for target in self.targets:
+            target._runState = state
+        self._stateCounts = {state: len(self.targets)}
+        self._stepCounts = dict((step, {}) for step in self.steps)
+        self._failedTargets = []
 
     def state(self):
-        targetStates = [target._state(self) for target in self.targets]
-        if TestState.PENDING in targetStates:
+        if self._stateCounts.get(TestState.PENDING, 0) > 0:
             return Test.State.PENDING
-        if all(targetState == TestState.ERROR for targetState in targetStates):
+        if self._stateCounts.get(TestState.ERROR, 0) == len(self.targets):
             return Test.State.ERROR
         return Test.State.COMPLETE
 
+    def _summarized(self):
+        return len(self.targets) > self.maxDisplayedTargets
+
+    def _setRunOrder(self, steps):
+        self._runOrder = steps
+        self._runIndex = dict((step, step_idx) for step_idx, step in enumerate(steps))
+
+    # Updates the state of a target after it has run a step
+    def _stepCompleted(self, step, target):
+        stepOutcome = step._outcome(target)
+        stepCounts = self._stepCounts.setdefault(step, {})
+        stepCounts[stepOutcome] = stepCounts.get(stepOutcome, 0) + 1
+        if stepOutcome == TestState.WARNING:
+            target._warned = True
+
+        if stepOutcome in TestState.abortingStatuses:
+            state = stepOutcome
+            self._failedTargets.append(target)
+        elif target._activeStep >= len(self._runOrder):
+            state = TestState.WARNING if target._warned else TestState.SUCCESS
+        else:
+            return
+        self._stateCounts[TestState.PENDING] -= 1
+        self._stateCounts[state] = self._stateCounts.get(state, 0) + 1
+        target._runState = state
+
     def run(self):
+        from .replay import ReplayedError
         self.reset()
-        for step in self.steps:
-            if step.groupExecution:
-                targetGroups = [self._activeTargets[:]] # run all targets at once
-            else:
-                targetGroups = [[target] for target in self._activeTargets[:]]  # run the test step for each individual target
-            for targetGroup in targetGroups:
-                try:
-                    step._run(targetGroup)
-                except Exception as e:
+        if self.optimizer is not None:
+            self._setRunOrder(self.optimizer.order(self.steps))
+        if self.replay is not None:
+            self.replay._begin(self.targets)
+        if self.recorder is not None:
+            self.recorder._begin(self.targets)
+        stepsFinished = False
+        try:
+            for step in self._runOrder:
+                activeTargets = list(self._activeTargets.keys())
+                if step.groupExecution:
+                    targetGroups = [activeTargets] # run all targets at once
+                else:
+                    targetGroups = [[target] for target in activeTargets]  # run the test step for each individual target
+                for targetGroup in targetGroups:
+                    erroredTargets = []
+                    if self.recorder is not None:
+                        self.recorder._beginStep()
+                    start = time.time()
+                    try:
+                        step._run(targetGroup)
+                    except Exception as e:
+                        # Replayed errors keep the traceback of the original exception
+                        trace = e.trace if isinstance(e, ReplayedError) and e.trace is not None else traceback.format_exc()
+                        for target in targetGroup:
+                            target._errors[step] = e
+                            target._trace[step] = trace
+                    duration = time.time() - start
+
                     for target in targetGroup:
-                        target._errors[step] = e
-                        target._trace[step] = traceback.format_exc()
-
-                for target in targetGroup:
-                    target._activeStep += 1
-
-                self._print()
-                for target in self._activeTargets:
-                    if step not in target._errors.keys():
-                        continue
-                    e = target._errors[step]
-                    if step in target._trace.keys():
-                        print(target._trace[step])
-                    logging.error(e.__class__.__name__)
-                    logging.error(e)
-
-            # eliminate target if it's failed
-            for target in self._activeTargets[:]:
-                if target._state(self) != TestState.PENDING:
-                    self._activeTargets.remove(target)
-
-            if self.state() == Test.State.COMPLETE or self.state() == Test.State.ERROR:
-                break
-
-        # Write to the CSV
-        for target in self.targets:
-            if target is not None:
-                for report in self.reports:
-                    report.writeEntry(self.exportResults(target))
+                        target._durations[step] = duration
+                    if self.recorder is not None:
+                        self.recorder._recordStep(step, targetGroup)
+
+                    for target in targetGroup:
+                        target._activeStep += 1
+                        self._stepCompleted(step, target)
+                        if step in target._errors.keys():
+                            erroredTargets.append(target)
+
+                    self._print()
+                    for target in erroredTargets:
+                        e = target._errors[step]
+                        if step in target._trace.keys():
+                            # Tracebacks would scroll the summary of large panels off the screen
+                            if self._summarized():
+                                logging.debug(target._trace[step])
+                            else:
+                                print(target._trace[step])
+                        logging.error(e.__class__.__name__)
+                        logging.error(e)
+
+                # eliminate target if it's failed
+                for target in activeTargets:
+                    if target._runState != TestState.PENDING:
+                        del self._activeTargets[target]
+
+                if self.state() == Test.State.COMPLETE or self.state() == Test.State.ERROR:
+                    break
+            stepsFinished = True
+
+            # Write to the CSV
+            for target in self.targets:
+                if target is not None:
+                    for report in self.reports:
+                        report.writeEntry(self.exportResults(target))
+            if self.optimizer is not None:
+                self.optimizer._observe(self)
+        finally:
+            # Keep the recording of whatever ran, even if the run was interrupted
+            if self.recorder is not None:
+                self.recorder._end(self.targets, stepsFinished)
         # TODO: Cleanup Step
 
     def _print(self):
@@ -243,19 +335,29 @@ class Test:
             return rows
 
 
+        # Large panels only display the outcome counts of each step and the failing targets
+        summarized = self._summarized()
+        summaryStates = [TestState.SUCCESS, TestState.WARNING, TestState.FAILURE, TestState.ERROR]
+
         # Format Test Results
         rows = [[]]
         rows[0].append("Step #")
-        if len(self.targets)>1:
-            rows[0].append("DUT")
-        rows[0].append("Status")
-        rows[0].append("Step")
-        rows[0].append("Results".ljust(40))
-
-        for step in self.steps:
-            for target_idx, target in enumerate(self.targets):
-                rows.extend(_stepRows(step, target, target_idx==0))
-                stepOutcome = step._outcome(target)
+        if summarized:
+            rows[0].append("Step")
+            rows[0].extend(summaryStates)
+            for step in self.steps:
+                stepCounts = self._stepCounts.get(step, {})
+                rows.append(["%s" % step.identifier, "%s" % step.description] + ["%d" % stepCounts.get(state, 0) for state in summaryStates])
+        else:
+            if len(self.targets)>1:
+                rows[0].append("DUT")
+            rows[0].append("Status")
+            rows[0].append("Step")
+            rows[0].append("Results".ljust(40))
+
+            for step in self.steps:
+                for target_idx, target in enumerate(self.targets):
+                    rows.extend(_stepRows(step, target, target_idx==0))
         width = alignColumnWidth(rows)
 
         # Clear screen
@@ -285,7 +387,31 @@ class Test:
         click.echo("\n") # New Line
 
         # Footer
-        if len(self.targets) == 1:
+        if summarized:
+            totals = "    ".join("%s: %s" % (state, click.style("%d" % self._stateCounts.get(state, 0), bold=True)) for state in [TestState.PENDING] + summaryStates)
+            click.echo(totals.center(width + lenOfAsciiEscapeChars(totals)))
+
+            if len(self._failedTargets) > 0:
+                click.echo("") # New Line
+                failedRows = [["DUT", "Status", "Failing Step", "Error"]]
+                for target in self._failedTargets[max(len(self._failedTargets) - self.maxDisplayedTargets, 0):]:
+                    state = target._runState
+                    failingStep = target._failingStep(self)
+                    error = str(target._errors[failingStep]) if failingStep in target._errors.keys() else ""
+                    failedRows.append(["%s" % target.name,
+                                       click.style("%s" % state, bg=TestState.color[state], fg=TestState.textColor[state]),
+                                       "#%s - %s" % (failingStep.identifier, failingStep.description),
+                                       error[0:50]])
+                alignColumnWidth(failedRows)
+                for row_idx, row in enumerate(failedRows):
+                    rowString = "".join(row)
+                    if row_idx == 0:
+                        rowString = click.style(rowString, fg='black', bg='white', bold=True) # Color the Header Row
+                    click.echo(rowString)
+                hiddenTargets = len(self._failedTargets) - self.maxDisplayedTargets
+                if hiddenTargets > 0:
+                    click.echo("... and %d more failing targets" % hiddenTargets)
+        elif len(self.targets) == 1:
             state = target._state(self)
             footerPadding = "".center(width) + '\n' + "".center(width) + '\n' + "".center(width)
             footer = (state).center(width)
@@ -393,13 +519,13 @@ class TestResult(object):
         self.criteria = convertedOutcome(criteria)
 
 @parametrizedDecorator
-def testStep(func, test, description, results=(), identifier=None, groupExecution=False):
-    step = TestStep(test, identifier, description, results, func, groupExecution)
+def testStep(func, test, description, results=(), identifier=None, groupExecution=False, dependsOn=None):
+    step = TestStep(test, identifier, description, results, func, groupExecution, dependsOn)
     test.addStep(step)
     return step
 
 class TestStep(object):
-    def __init__(self, test, identifier, description, results, function, groupExecution=False):
+    def __init__(self, test, identifier, description, results, function, groupExecution=False, dependsOn=None):
         self._test = test
         self.identifier = identifier
         self.description = description
@@ -407,22 +533,30 @@ class TestStep(object):
         self.results = results if isinstance(results, tuple) else (results,)
         self._function = function
         self.groupExecution = groupExecution
+        # Steps that must run before this one. None means every step added before it.
+        if dependsOn is not None:
+            dependsOn = tuple(dependsOn) if isinstance(dependsOn, (list, tuple)) else (dependsOn,)
+        self.dependsOn = dependsOn
 
     def prompt(self, message):
-        return promptFunc(message)
+        answer = promptFunc(message)
+        if self._test.recorder is not None:
+            self._test.recorder._recordPrompt(message, answer)
+        return answer
 
     def _outcome(self, target):
-        # Check if this test is aborted
-        stepIdx = self._test.steps.index(self)
-        if stepIdx > 0:
-            previousStepState = self._test.steps[stepIdx-1]._outcome(target)
-            if (previousStepState in TestState.abortingStatuses) or (previousStepState == TestState.ABORTED):
-                return TestState.ABORTED
-
-        # Check if this test is pending
-        if target._activeStep <= self._test.steps.index(self):
+        # Steps the target hasn't run yet are aborted if the last step it ran stopped the test, otherwise pending
+        stepIdx = self._test._runIndex[self]
+        if target._activeStep <= stepIdx:
+            if target._activeStep > 0:
+                lastStep = self._test._runOrder[target._activeStep-1]
+                if lastStep._resultOutcome(target) in TestState.abortingStatuses:
+                    return TestState.ABORTED
             return TestState.PENDING
+        return self._resultOutcome(target)
 
+    # Outcome of a step the target has already run
+    def _resultOutcome(self, target):
         # Check if an Error had been produced
         if self in target._errors.keys() and target._errors[self] != None:
                 return TestState.ERROR
@@ -447,7 +581,114 @@ class TestStep(object):
         return TestState.SUCCESS
 
     def _run(self, targets):
+        if self._test.replay is not None:
+            self._test.replay._playStep(self, targets)
+        else:
+            self._execute(targets)
+
+    def _execute(self, targets):
         if self.groupExecution:
             self._function(self, targets)
         else:
             self._function(self, targets[0])
+
+
+class TestPanel(unittest.TestCase):
+    def _buildTest(self, modes, maxDisplayedTargets=16):
+        targets = [DeviceUnderTest("T%d" % idx) for idx in range(len(modes))]
+        test = Test(targets=targets, name="Panel Test", maxDisplayedTargets=maxDisplayedTargets)
+        self.modes = dict(zip(targets, modes))
+        self.executed = []
+        self.outcomes = {}
+        value = TestResult("Value", criteria=lambda x: x is not None and x > 0)
+
+        def measure(step, target):
+            if self.modes[target] == "error":
+                raise IOError("Instrument not found")
+            target.resultValues[value] = 1 if self.modes[target] == "pass" else -1
+        test.addStep(TestStep(test, None, "Measure", (value,), measure))
+
+        def check(step, target):
+            self.executed.append(target)
+            self.activeTargets = list(test._activeTargets.keys())
+            for other in test.targets:
+                self.outcomes[other] = [s._outcome(other) for s in test.steps]
+        test.addStep(TestStep(test, None, "Check", (), check))
+        test.addStep(TestStep(test, None, "Finish", (), lambda step, target: None))
+        return test
+
+    def _run(self, test):
+        import io
+        import contextlib
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            test.run()
+        return output.getvalue()
+
+    def test_states(self):
+        test = self._buildTest(["pass", "fail", "error"])
+        passing, failing, erroring = test.targets
+        self.assertEqual(test.steps[0]._outcome(passing), TestState.PENDING)
+        self.assertEqual(test.state(), Test.State.PENDING)
+
+        output = self._run(test)
+        self.assertEqual(output.count("Traceback"), 1)
+        self.assertEqual(self.executed, [passing])
+        self.assertEqual(self.activeTargets, [passing])
+        self.assertEqual(self.outcomes[passing], [TestState.SUCCESS, TestState.PENDING, TestState.PENDING])
+        self.assertEqual(self.outcomes[failing], [TestState.FAILURE, TestState.ABORTED, TestState.ABORTED])
+        self.assertEqual(self.outcomes[erroring], [TestState.ERROR, TestState.ABORTED, TestState.ABORTED])
+
+        self.assertEqual(self._runStates(test), {TestState.PENDING: 0, TestState.SUCCESS: 1, TestState.FAILURE: 1, TestState.ERROR: 1})
+        self.assertEqual([target._runState for target in test.targets], [target._state(test) for target in test.targets])
+        self.assertEqual(len(test._activeTargets), 0)
+        self.assertEqual(test.state(), Test.State.COMPLETE)
+
+    def test_allErrors(self):
+        test = self._buildTest(["error", "error", "error"])
+        output = self._run(test)
+        self.assertEqual(output.count("Traceback"), 3)
+        self.assertEqual(self._runStates(test), {TestState.PENDING: 0, TestState.SUCCESS: 0, TestState.FAILURE: 0, TestState.ERROR: 3})
+        self.assertEqual(test.state(), Test.State.ERROR)
+
+    def test_summary(self):
+        test = self._buildTest(["error"] * 10 + ["fail"] * 10, maxDisplayedTargets=4)
+        with self.assertLogs(level="DEBUG") as logs:
+            output = self._run(test)
+        self.assertNotIn("Traceback", output)
+        # Every error is still logged
+        self.assertEqual(logs.output.count("ERROR:root:Instrument not found"), 10)
+        self.assertEqual(len([line for line in logs.output if line.startswith("DEBUG:root:Traceback")]), 10)
+        self.assertEqual(test.state(), Test.State.COMPLETE)
+
+        lastScreen = output.split("Step #")[-1]
+        self.assertIn("Pass    Warning    Fail    ERROR", lastScreen)
+        self.assertIn("Pending: 0    Pass: 0    Warning: 0    Fail: 10    ERROR: 10", lastScreen)
+        self.assertIn("... and 16 more failing targets", lastScreen)
+        # Only the most recent failing targets are listed
+        self.assertIn("T19", lastScreen)
+        self.assertNotIn("T15", lastScreen)
+        self.assertNotIn("Results", lastScreen)
+
+    def test_summaryWithoutRows(self):
+        test = self._buildTest(["fail"] * 3, maxDisplayedTargets=0)
+        lastScreen = self._run(test).split("Step #")[-1]
+        self.assertIn("... and 3 more failing targets", lastScreen)
+        self.assertNotIn("T0", lastScreen)
+
+    def test_noSteps(self):
+        test = Test(targets=[DeviceUnderTest("T0"), DeviceUnderTest("T1")])
+        self.assertEqual(test.state(), Test.State.COMPLETE)
+        self._run(test)
+        self.assertEqual(test.state(), Test.State.COMPLETE)
+        self.assertEqual(self._runStates(test)[TestState.SUCCESS], 2)
+        self.assertEqual([target._runState for target in test.targets], [target._state(test) for target in test.targets])
+
+        test.addStep(TestStep(test, None, "Measure", (), lambda step, target: None))
+        self.assertEqual(test.state(), Test.State.PENDING)
+
+    def _runStates(self, test):
+        return dict((state, test._stateCounts.get(state, 0)) for state in [TestState.PENDING, TestState.SUCCESS, TestState.FAILURE, TestState.ERROR])
+
+if __name__ == '__main__':
+    unittest.main()